@@ -23,28 +23,219 @@ used the smooth the image values. Other options include
         output images with adjusted means in the directory specified by
         ``<output>``. If the directory is the same as ``<directory>``, the
         smoothing is done in-place and the input files are overwritten.
+        Images that are not RGB are converted to RGB, so any alpha channel
+        is dropped from the output.
+    ``--cache``:
+        keep the decoded images in memory between computing the RGB timeseries
+        and adjusting the images, so each image is only decoded once. This
+        needs enough memory to hold every image in the sequence, and a
+        platform that can start processes with fork.
+    ``--gpu``:
+        adjust the images on a CUDA GPU with CuPy, which must be installed
+        separately. Images are still decoded and encoded on the CPU.
+    ``--draft``:
+        compute the RGB timeseries from JPEG images decoded at a quarter of
+        their width and height, which is much faster but only approximates
+        the image means, so the adjusted images can differ slightly from a
+        run without ``--draft``. Cannot be combined with ``--cache``.
 
 .. moduleauthor Tristan Abbott
 """
 
-from libdeflicker import meanRGB, squareFilter, relaxToMean, toIntColor
+from libdeflicker import squareFilter, relaxToMean, toIntColor, scaleForMean
 import os
 import re
 import sys
 from PIL import Image
-from matplotlib import pyplot as plt
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from multiprocessing import Pool, get_context
+import numba
+
+def _meanRGB8(img):
+    """
+    Return the mean R, G, and B values of the 8-bit image ``img`` as [0,1]
+    floating point numbers.
+    """
+    # Sum the 8-bit values exactly and rescale only the per-attribute sums
+    return img.reshape(-1, img.shape[2]).sum(axis = 0, dtype = np.uint64) / \
+        (img.shape[0] * img.shape[1] * 255.)
+
+def _toRGB(img):
+    """
+    Return the PIL image ``img`` in RGB mode, converting it (and dropping any
+    alpha channel) only if it is in another mode.
+    """
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+def _loadImage(path):
+    """
+    Load the image in ``path`` as an 8-bit RGB array.
+    """
+    return np.asarray(_toRGB(Image.open(path)))
+
+def _loadMean(path):
+    """
+    Load the image in ``path`` and return its mean R, G, and B values as
+    [0,1] floating point numbers.
+    """
+    return _meanRGB8(_loadImage(path))
+
+def _loadDraftMean(path):
+    """
+    Like ``_loadMean``, but decode JPEG images at a quarter of their width and
+    height, which libjpeg does cheaply by scaling in the DCT domain. The means
+    are only approximately those of the full image.
+    """
+    img = Image.open(path)
+    img.draft('RGB', (max(1, img.width // 4), max(1, img.height // 4)))
+    return _meanRGB8(np.asarray(_toRGB(img)))
+
+def _initWorker():
+    """
+    Run the Numba kernels single-threaded in each worker, since the images are
+    already spread over one worker per core.
+    """
+    numba.set_num_threads(1)
+
+def _adjust(img, rgb, path):
+    """
+    Adjust the 8-bit image ``img`` to have the mean R, G, and B values in
+    ``rgb`` and save it in ``path``.
+    """
+    # Store each attribute contiguously, keeping the pixel-major view that
+    # libdeflicker expects, so relaxToMean histograms one plane at a time
+    planes = np.empty((img.shape[2],) + img.shape[:2], dtype = np.float32)
+    np.multiply(img.transpose(2, 0, 1), np.float32(1. / 255.), out = planes)
+    img = planes.transpose(1, 2, 0)
+    relaxToMean(img, rgb)
+    jpg = Image.fromarray(toIntColor(img))
+    jpg.save(path)
+
+def _processOne(args):
+    """
+    Adjust the image ``ff`` in directory ``loc`` to have the mean R, G, and B
+    values in ``rgb`` and save it under the same name in directory
+    ``output``. ``args`` is the tuple ``(ff, loc, output, rgb)``.
+    """
+    ff, loc, output, rgb = args
+    _adjust(_loadImage('%s/%s' % (loc, ff)), rgb, '%s/%s' % (output, ff))
+
+# Images decoded by the mean pass when --cache is given. Pool workers started
+# with fork inherit this list, so cached images are never pickled.
+_cache = []
+
+def _adjustCached(args):
+    """
+    Adjust the cached image ``_cache[ii]`` to have the mean R, G, and B values
+    in ``rgb`` and save it in ``path``, releasing this process's reference to
+    it. ``args`` is the tuple ``(ii, rgb, path)``; returns ``ii``.
+    """
+    ii, rgb, path = args
+    img, _cache[ii] = _cache[ii], None
+    _adjust(img, rgb, path)
+    return ii
+
+def _saveImage(img, path):
+    """
+    Save the 8-bit image ``img`` in ``path``.
+    """
+    Image.fromarray(img).save(path)
+
+def _prefetch(paths, depth):
+    """
+    Yield the 8-bit images in ``paths`` in order, decoding up to ``depth``
+    images ahead in background threads.
+    """
+    with ThreadPoolExecutor(max_workers = depth) as ex:
+        pending = deque(ex.submit(_loadImage, p) for p in paths[:depth])
+        for p in paths[depth:]:
+            img = pending.popleft().result()
+            pending.append(ex.submit(_loadImage, p))
+            yield img
+        while pending:
+            yield pending.popleft().result()
+
+def _release(imgs):
+    """
+    Yield the images in the list ``imgs`` in order, dropping each one from the
+    list as it is handed out.
+    """
+    for ii in range(len(imgs)):
+        img, imgs[ii] = imgs[ii], None
+        yield img
+
+def _adjustGPU(imgs, rgbi, paths):
+    """
+    Adjust each 8-bit image from the iterable ``imgs`` to have the mean R, G,
+    and B values in the matching row of ``rgbi`` and save it in the matching
+    entry of ``paths``, using CuPy to scale the images on the GPU.
+
+    The scaling factors are computed in closed form from the 8-bit
+    histograms (see ``scaleForMean``), so each image is adjusted by one fused
+    multiply, clip and round kernel. The GPU steps for one image run one after
+    another; what overlaps with them is decoding upcoming images (when
+    ``imgs`` is a ``_prefetch`` generator) and encoding earlier ones, of which
+    at most ``os.cpu_count()`` are in flight at a time.
+    """
+    import cupy as cp
+    import cupyx
+
+    def pinned(buf, shape):
+        # Reuse the pinned buffer ``buf`` if it is large enough for ``shape``
+        size = int(np.prod(shape))
+        if buf is None or buf.size < size:
+            buf = cupyx.empty_pinned(size, dtype = np.uint8)
+        return buf, buf[:size].reshape(shape)
+
+    scale = cp.ElementwiseKernel('uint8 x, float32 s', 'uint8 y',
+        'y = (unsigned char)(min(255.f, x * s) + 0.5f)', 'deflicker_scale')
+    stream = cp.cuda.Stream(non_blocking = True)
+    depth = os.cpu_count()
+    # One pinned upload buffer and a ring of pinned download buffers, one per
+    # save that can be in flight
+    upload = None
+    ring = [None] * depth
+    saves = deque()
+    with ThreadPoolExecutor(max_workers = depth) as ex, stream:
+        for ii, (img, rgb, path) in enumerate(zip(imgs, rgbi, paths)):
+            # Wait for the oldest save so its download buffer can be reused
+            if len(saves) == depth:
+                saves.popleft().result()
+            upload, host = pinned(upload, img.shape)
+            host[...] = img
+            d = cp.empty(img.shape, dtype = cp.uint8)
+            d.set(host, stream = stream)
+            # Per-channel histograms in one pass. Copying them back to the
+            # host waits for the upload, so the upload buffer is free again
+            # by the next image.
+            c = img.shape[2]
+            offset = cp.arange(c) * 256
+            hist = cp.bincount((d.reshape(-1, c) + offset).ravel(),
+                minlength = 256 * c).get(stream = stream).reshape(c, 256)
+            s = np.array([scaleForMean(hist[k], rgb[k]) for k in range(c)],
+                dtype = np.float32)
+            ring[ii % depth], out = pinned(ring[ii % depth], img.shape)
+            scale(d, cp.asarray(s)).get(stream = stream, out = out)
+            stream.synchronize()
+            saves.append(ex.submit(_saveImage, out, path))
+        while saves:
+            saves.popleft().result()
 
 if __name__ == "__main__":
 
     # Process input arguments
     if len(sys.argv) < 3:
-        print 'Usage: python deflicker.py <directory> <width> [..]'
-        exit(0)
+        print('Usage: python deflicker.py <directory> <width> [..]')
+        sys.exit(0)
     loc = sys.argv[1]
     w = int(sys.argv[2])
     __plot = False
     __adjust = False
+    __cache = False
+    __gpu = False
+    __draft = False
 
     for ii in range(3, len(sys.argv)):
         a = sys.argv[ii]
@@ -54,46 +245,49 @@ if __name__ == "__main__":
         elif a == '--adjust':
             __adjust = True
             __output = sys.argv[ii+1]
+        elif a == '--cache':
+            __cache = True
+        elif a == '--gpu':
+            __gpu = True
+        elif a == '--draft':
+            __draft = True
 
     # Just stop if not told to do anything
     if not (__plot or __adjust):
-        print 'Exiting without doing anything'
-        exit(0)
+        print('Exiting without doing anything')
+        sys.exit(0)
+    if __draft and __cache:
+        print('--draft and --cache cannot be used together')
+        sys.exit(1)
 
-	# Get list of image names in order
+    # Get list of image names in order
     loc = sys.argv[1]
-    f = os.listdir(loc)
-    n = []
-    ii = 0
-    while ii < len(f):
-        match = re.search('\d+', f[ii])
-        if match is not None:
-            n.append(int(match.group(0)))
-            ii += 1
-        else:
-            f.pop(ii)
-    n = np.array(n)
-    i = np.argsort(n)
-    f = [f[ii] for ii in i]
+    pat = re.compile(r'\d+')
+    matches = [(pat.search(ff), ff) for ff in os.listdir(loc)]
+    f = [ff for _, ff in sorted((int(m.group(0)), ff)
+        for m, ff in matches if m is not None)]
 
     # Load images and calculate smoothed RGB curves
-    print 'Calculating smoothed sequence'
+    print('Calculating smoothed sequence')
     n = len(f)
-    rgb = np.zeros((n, 3))
-    ii = 0
-    for ff in f:
-        img = np.asarray(Image.open('%s/%s' % (loc, ff))) / 255.
-        rgb[ii,:] = meanRGB(img)
-        ii += 1
+    paths = ['%s/%s' % (loc, ff) for ff in f]
+    with ThreadPoolExecutor(max_workers = os.cpu_count()) as ex:
+        if __cache and __adjust:
+            # Keep the decoded images for the adjustment pass
+            _cache = list(ex.map(_loadImage, paths))
+            rgb = np.array(list(ex.map(_meanRGB8, _cache))).reshape(n, 3)
+        else:
+            load = _loadDraftMean if __draft else _loadMean
+            rgb = np.array(list(ex.map(load, paths))).reshape(n, 3)
 
     # Filter series
-    rgbi = np.zeros(rgb.shape)
-    for ii in range(0,3):
-        rgbi[:,ii] = squareFilter(rgb[:,ii], w)
+    rgbi = squareFilter(rgb, w)
 
     # Print initial and filtered series
     if __plot:
-        print 'Plotting smoothed and unsmoothed sequences in %s' % __file
+        print('Plotting smoothed and unsmoothed sequences in %s' % __file)
+        # Only pay for importing matplotlib when a plot is requested
+        from matplotlib import pyplot as plt
         plt.subplot(1, 2, 1)
         plt.plot(rgb[:,0], 'r', rgb[:,1], 'g', rgb[:,2], 'b')
         plt.title('Unfiltered RGB sequence')
@@ -102,15 +296,24 @@ if __name__ == "__main__":
         plt.title('Filtered RGB sequence (w = %d)' % w)
         plt.savefig(__file)
 
-    # Process images sequentially
-    if __adjust:
-        print 'Processing images'
-        ii = 0
-        for ff in f:
-            img = np.asarray(Image.open('%s/%s' % (loc, ff))) / 255.
-            relaxToMean(img, rgbi[ii,:])
-            jpg = Image.fromarray(toIntColor(img))
-            jpg.save('%s/%s' % (__output, ff))
-            ii += 1
-
-    print 'Finished'
+    # Process images
+    if __adjust and __gpu:
+        print('Processing images on the GPU')
+        _adjustGPU(_release(_cache) if __cache else
+            _prefetch(paths, os.cpu_count()), rgbi,
+            ['%s/%s' % (__output, ff) for ff in f])
+    elif __adjust and __cache:
+        print('Processing images')
+        # Fork so the workers share the cached images with this process, and
+        # drop each image here as soon as it has been saved
+        with get_context('fork').Pool(initializer = _initWorker) as pool:
+            for ii in pool.imap_unordered(_adjustCached, [(ii, rgbi[ii,:],
+                    '%s/%s' % (__output, ff)) for ii, ff in enumerate(f)]):
+                _cache[ii] = None
+    elif __adjust:
+        print('Processing images')
+        with Pool(initializer = _initWorker) as pool:
+            pool.map(_processOne, [(ff, loc, __output, rgbi[ii,:])
+                for ii, ff in enumerate(f)])
+
+    print('Finished')
@@ -7,7 +7,15 @@ Library routines for image deflickering.
 """
 
 import numpy as np
-from scipy import signal
+from numba import njit, prange, get_num_threads
+from scipy.ndimage import uniform_filter1d
+
+# Kernels compiled ahead of time for float32 images by libdeflicker_aot.py, if
+# they have been built
+try:
+    import _libdeflicker_aot as _aot
+except ImportError:
+    _aot = None
 
 def squareFilter(sig, w):
     """
@@ -15,27 +23,25 @@ def squareFilter(sig, w):
     --------------------
     Smooth a signal with a square filter.
 
-    This function is just a wrapper for scipy.signal.convolve with a kernel
-    given by ``np.ones(w)/w``.
+    This function is just a wrapper for scipy.ndimage.uniform_filter1d, which
+    computes a running mean of width ``w`` in time that does not depend on
+    ``w``. The signal is extended at each end with copies of its endpoint
+    values. Multidimensional signals are smoothed along their first dimension,
+    so several signals can be filtered at once by stacking them as columns.
 
     Parameters:
         sig: np.array
-            Unsmoothed signal
+            Unsmoothed signal. If ``sig`` has more than one dimension, each
+            slice along the first dimension is one sample.
         w: int
             Width of the filter
 
     Returns:
         np.array
-            Smoothed signal
+            Smoothed signal, with the same shape as ``sig``
     """
-    # Create filter
-    win = np.ones(w)
-    # Pad input
-    sigp = np.concatenate(([np.tile(sig[0], w/2), sig,
-        np.tile(sig[-1], w/2)]))
-    # Filter
-    return signal.convolve(sigp, win, mode =
-               'same')[w/2:-w/2+1] / np.sum(win)
+    return uniform_filter1d(np.asarray(sig, dtype = np.float64), size = w,
+        axis = 0, mode = 'nearest')
 
 # Compute image-mean RGB values
 def meanRGB(img, ii = -1):
@@ -67,10 +73,106 @@ def meanRGB(img, ii = -1):
             of average over the first two dimensions for each slice in the
             third dimension.
     """
-    if ii < 0:
-        return np.array([np.mean(img[:,:,i]) for i in range(0,img.shape[2])])
+    if ii < 0 and img.dtype == np.float32:
+        return _kernel('mean_rgb_f32', _meanAttributes, img)(img)
+    elif ii < 0:
+        # One pass over contiguous pixels rather than one strided pass per
+        # attribute
+        return img.reshape(-1, img.shape[2]).mean(axis = 0, dtype = np.float64)
     else:
-        return np.mean(img[:,:,ii])
+        return np.mean(img[:,:,ii], dtype = np.float64)
+
+# Find the factor that scales a histogram of attribute values to a given mean
+def scaleForMean(hist, m):
+    """
+    scaleForMean(hist, m)
+    ---------------------
+    Compute the uniform scaling factor that gives attributes a specified mean.
+
+    This function takes a histogram of attribute values that are evenly spaced
+    between 0 and 1, inclusive, and finds the factor ``s`` such that the mean
+    of ``min(1, s*x)`` over all the values ``x`` is ``m``. Because this mean
+    is piecewise linear in ``s``, with a break wherever another level is
+    clipped to 1, the factor is found in closed form without iterating over
+    the pixels.
+
+    Parameters:
+        hist: np.array
+            Number of values at each level. ``hist[k]`` is the number of values
+            equal to ``k/(len(hist)-1)``, so an 8-bit histogram has 256 bins.
+        m: float
+            Desired mean value.
+
+    Returns:
+        float
+            The scaling factor. If ``m`` is larger than the mean obtained by
+            clipping every nonzero value to 1, the smallest factor that does so
+            is returned.
+    """
+    hist = np.asarray(hist, dtype = np.float64)
+    nlev = hist.size - 1
+    n = np.sum(hist)
+    # Number of values at or above each level and sum of levels below each
+    # level, with an extra entry for a level above the largest one
+    cge = np.append(np.cumsum(hist[::-1])[::-1], 0.)
+    slt = np.append(0., np.cumsum(hist * np.arange(nlev + 1)))
+    # Mean after scaling by nlev/k, i.e. when level k is just clipped to 1
+    k = np.arange(1, nlev + 1)
+    fk = (cge[k] + slt[k] / k) / n
+    if m >= fk[0]:
+        return float(nlev)
+    # Levels at or above kc are clipped at the solution
+    clipped = fk <= m
+    kc = k[np.argmax(clipped)] if np.any(clipped) else nlev + 1
+    return (m * n - cge[kc]) * nlev / slt[kc]
+
+# Select the compiled version of a kernel
+def _kernel(name, jit, img):
+    """
+    Return the ahead-of-time compiled kernel ``name`` if it has been built,
+    ``img`` is float32, and Numba is limited to one thread, or the
+    JIT-compiled kernel ``jit`` otherwise. The AOT kernels are
+    single-threaded, so the parallel JIT kernels are preferred whenever more
+    than one thread is available. A module built from older sources that
+    lacks ``name`` also falls back to ``jit``.
+    """
+    if _aot is not None and img.dtype == np.float32 and \
+            get_num_threads() == 1:
+        return getattr(_aot, name, jit)
+    return jit
+
+# Average each attribute over all pixels
+@njit(parallel = True, fastmath = True, cache = True)
+def _meanAttributes(img):
+    """
+    Return the mean of each slice in the third dimension of ``img``,
+    accumulated in double precision.
+    """
+    h, w, c = img.shape
+    part = np.zeros((h, c))
+    for i in prange(h):
+        for j in range(w):
+            for k in range(c):
+                part[i,k] += img[i,j,k]
+    return part.sum(axis = 0) / (h * w)
+
+# Scale and clip every attribute in place and return the new means
+@njit(parallel = True, fastmath = True, error_model = 'numpy', cache = True)
+def _relaxAttributes(img, r):
+    """
+    Replace each slice ``img[:,:,k]`` with ``min(1, img[:,:,k]*r[k])`` in a
+    single pass over the image and return the mean of each slice of the
+    result.
+    """
+    h, w, c = img.shape
+    part = np.zeros((h, c))
+    for i in prange(h):
+        for j in range(w):
+            for k in range(c):
+                v = min(1., img[i,j,k] * r[k])
+                img[i,j,k] = v
+                part[i,k] += v
+    return part.sum(axis = 0) / (h * w)
 
 # Adjust pixel-by-pixel RGB values to converge to correct mean 
 # by multiplying them by a uniform value.
@@ -93,7 +195,9 @@ def relaxToMean(img, rgb):
             Array image representation. The first two dimensions should
             represent pixel positions, and each position in the third dimension
             can represent a particular pixel attribute, e.g. an R, G, or B
-            value; an H, S, or V value, etc.
+            value; an H, S, or V value, etc. Histograms are taken one attribute
+            at a time, so this is fastest when each slice ``img[:,:,i]`` is
+            contiguous, e.g. for a transposed view of a planar array.
         rgb: np.array
             Desired image-mean values for each attribute included in ``img``.
             The linear indices of the values in this array should map in order
@@ -107,21 +211,31 @@ def relaxToMean(img, rgb):
             in ``rgb``.
 
     """
-    rgbi = meanRGB(img)
-    fac = np.array([2. if i else 0.5 for i in rgbi < rgb])
+    rgb = np.asarray(rgb, dtype = np.float64)
+    relax = _kernel('relax_attributes_f32', _relaxAttributes, img)
 
-    # Relax toward mean
-    for ii in range(0,3):
+    # Start from the closed-form factors for 8-bit attributes
+    r = np.empty(img.shape[2])
+    for ii in range(0, img.shape[2]):
+        lev = np.rint(img[:,:,ii] * 255.).astype(np.uint8)
+        r[ii] = scaleForMean(np.bincount(lev.ravel(), minlength = 256),
+            rgb[ii])
+    rgbi = relax(img, r.astype(img.dtype))
 
-        # Repeat until converged to mean
-        while not np.isclose(rgbi[ii], rgb[ii]):
+    # Repeat until converged to mean, with the same tolerance as np.isclose.
+    # Attributes that came from 8-bit values are already converged; stop
+    # early for attributes whose mean is out of reach because every nonzero
+    # value has been clipped.
+    tol = 1e-8 + 1e-5 * np.abs(rgb)
+    active = (np.abs(rgbi - rgb) > tol) & (rgbi > 0)
+    while np.any(active):
 
-            # Compute ratio
-            r = rgb[ii] / rgbi[ii]
-            # Relax image
-            img[:,:,ii] = np.minimum(1., img[:,:,ii] * r)
-            # Update average
-            rgbi[ii] = meanRGB(img, ii)
+        # Compute ratios, leaving converged attributes unchanged
+        r = np.where(active, rgb / np.where(active, rgbi, 1.), 1.)
+        # Relax image and update averages
+        last = rgbi
+        rgbi = relax(img, r.astype(img.dtype))
+        active = (np.abs(rgbi - rgb) > tol) & (rgbi > 0) & (rgbi != last)
 
 # Convert floating point colors to integer colors
 def toIntColor(img, t = np.uint8):
@@ -151,5 +265,25 @@ def toIntColor(img, t = np.uint8):
             Representation of the attributes of ``img`` using the type
             specified by ``t``.
     """
+    if t is np.uint8 and img.dtype == np.float32:
+        return _kernel('to_u8', _toUInt8, img)(img)
     scale = np.iinfo(t).max
-    return np.round(img * scale).astype(t)
+    # Round in place in the scaled copy; the cast truncates the nonnegative
+    # values after adding 0.5
+    out = img * scale
+    out += 0.5
+    return out.astype(t)
+
+# Convert [0,1] attributes to rounded 8-bit values
+@njit(parallel = True, cache = True)
+def _toUInt8(img):
+    """
+    Return ``img`` scaled by 255 and rounded to the nearest ``np.uint8``.
+    """
+    h, w, c = img.shape
+    out = np.empty((h, w, c), dtype = np.uint8)
+    for i in prange(h):
+        for j in range(w):
+            for k in range(c):
+                out[i,j,k] = np.uint8(img[i,j,k] * 255. + 0.5)
+    return out
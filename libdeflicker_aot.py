@@ -0,0 +1,28 @@
+"""
+libdeflicker_aot.py
+-------------------
+Ahead-of-time compilation of the libdeflicker kernels.
+
+Run ``python libdeflicker_aot.py`` once to build the ``_libdeflicker_aot``
+extension module next to this file. When it is present, libdeflicker uses the
+compiled kernels for float32 images instead of compiling them with Numba's JIT
+at the start of every run.
+
+.. moduleauthor Tristan Abbott
+"""
+
+import os
+from numba.pycc import CC
+from libdeflicker import _meanAttributes, _relaxAttributes, _toUInt8
+
+cc = CC('_libdeflicker_aot')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Export the same Python sources that libdeflicker compiles with the JIT
+cc.export('mean_rgb_f32', 'f8[:](f4[:,:,:])')(_meanAttributes.py_func)
+cc.export('relax_attributes_f32', 'f8[:](f4[:,:,:], f4[:])')(
+    _relaxAttributes.py_func)
+cc.export('to_u8', 'u1[:,:,:](f4[:,:,:])')(_toUInt8.py_func)
+
+if __name__ == "__main__":
+    cc.compile()